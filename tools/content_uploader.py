@@ -16,16 +16,17 @@
 
 """The script to upload generated artifacts from build server to CAS."""
 import argparse
+import concurrent.futures
 import dataclasses
-import glob
+import fnmatch
 import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 import tempfile
 import time
-import re
 
 
 @dataclasses.dataclass
@@ -42,7 +43,7 @@ class ArtifactConfig:
     exclude_filters: list[str] = dataclasses.field(default_factory=list)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class CasInfo:
     """Basic information of CAS server and client.
 
@@ -52,13 +53,14 @@ class CasInfo:
         client_path: path to the CAS uploader client.
         version: version of the CAS uploader client, in turple format.
     """
+    __slots__ = ('cas_instance', 'cas_service', 'client_path', 'client_version')
     cas_instance: str
     cas_service: str
     client_path: str
     client_version: tuple
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class UploadResult:
     """Result of uploading a single artifact with CAS client.
 
@@ -66,20 +68,50 @@ class UploadResult:
         digest: root digest of the artifact.
         content_details: detail information of all uploaded files inside the uploaded artifact.
     """
+    __slots__ = ('digest', 'content_details')
     digest: str
     content_details: list[dict[str,any]]
 
 
+@dataclasses.dataclass(frozen=True)
+class UploadTask:
+    """A file to be uploaded to CAS.
+
+    Attributes:
+        artifact: configuration of the artifact that the file matches.
+        path: path to the file to be uploaded.
+    """
+    __slots__ = ('artifact', 'path')
+    artifact: ArtifactConfig
+    path: str
+
+
 CAS_UPLOADER_PREBUILT_PATH = 'tools/tradefederation/prebuilts/'
 CAS_UPLOADER_PATH = 'tools/content_addressed_storage/prebuilts/'
 CAS_UPLOADER_BIN = 'casuploader'
 
+# Version in the output of `casuploader -version`, formatted as "version: <major>.<minor>".
+_VERSION_RE = re.compile(rb'version:\s+(\d+)\.(\d+)')
+
+# Timeout of uploading a single artifact when it has the bandwidth to itself. Concurrent uploads
+# share the bandwidth, so the timeout is multiplied by the number of uploads running at the same
+# time, up to UPLOADER_MAX_TIMEOUT_SECS.
 UPLOADER_TIMEOUT_SECS = 600 # 10 minutes
+UPLOADER_MAX_TIMEOUT_SECS = 1800 # 30 minutes
+
+# Default number of artifacts uploaded in parallel, each upload runs its own casuploader process.
+# Kept small since the uploads share the network bandwidth of the build server. Can be overridden
+# by the `--max_workers` argument.
+MAX_WORKERS = 4
 
 DIGESTS_PATH = 'cas_digests.json'
 LOG_PATH = 'logs/cas_uploader.log'
+ENV_PATH = 'logs/cas_uploader_env.json'
 CONTENT_DETAILS_PATH = 'logs/cas_content_details.json'
 
+# Write buffer size of the output files, json.dump writes many small chunks.
+OUTPUT_BUFFER_SIZE = 128 * 1024
+
 # Configurations of artifacts will be uploaded to CAS.
 # TODO(b/298890453) Add artifacts after this script is attached to build process.
 ARTIFACTS = [
@@ -133,29 +165,34 @@ def _get_client() -> str:
     if os.path.isfile(bin_path):
         logging.info('Using client at %s', bin_path)
         return bin_path
-    client = glob.glob(CAS_UPLOADER_PREBUILT_PATH + '**/' + CAS_UPLOADER_BIN, recursive=True)
+    # Stop at the first match instead of listing the whole prebuilts tree.
+    client = next((entry.path for entry in _walk_files(CAS_UPLOADER_PREBUILT_PATH)
+                   if entry.name == CAS_UPLOADER_BIN), None)
     if not client:
         raise ValueError('Could not find casuploader binary')
-    logging.info('Using client at %s', client[0])
-    return client[0]
+    logging.info('Using client at %s', client)
+    return client
 
 
-def _get_client_version(client_path: str) -> int:
+def _get_client_version(client_path: str) -> tuple[int, int]:
     """Get the version of CAS client in turple format."""
-    version_output = ''
+    version_output = b''
     try:
-        version_output = subprocess.check_output([client_path, '-version']).decode('utf-8').strip()
-        matched = re.findall(r'version: (\d+\.\d+)', version_output)
+        # Search the raw output, it only has to be decoded when the version is not found.
+        version_output = subprocess.check_output([client_path, '-version'])
+        matched = _VERSION_RE.search(version_output)
         if not matched:
-            logging.warning('Failed to parse CAS client version. Output: %s', version_output)
+            logging.warning('Failed to parse CAS client version. Output: %s',
+                            version_output.decode('utf-8', errors='replace').strip())
             return (0, 0)
-        version = tuple(map(int, matched[0].split('.')))
+        version = (int(matched[1]), int(matched[2]))
         logging.info('CAS client version is %s', version)
         return version
     # pylint: disable=broad-exception-caught
     except Exception as e:
     # pylint: enable=broad-exception-caught
-        logging.warning('Failed to get CAS client version. Output: %s. Error %s', version_output, e)
+        logging.warning('Failed to get CAS client version. Output: %s. Error %s',
+                        version_output.decode('utf-8', errors='replace').strip(), e)
         return (0, 0)
 
 
@@ -166,6 +203,13 @@ def _get_env_var(key: str, default=None, check=False):
     return value
 
 
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
 def _parse_additional_artifacts(args) -> list[ArtifactConfig]:
     additional_artifacts = []
     for config in args.experiment_artifacts:
@@ -180,19 +224,95 @@ def _parse_additional_artifacts(args) -> list[ArtifactConfig]:
     return additional_artifacts
 
 
+def _merge_exclude_filters(exclude_filters: list[str]) -> str:
+    """Merge the exclude filters into a single regular expression.
+
+    casuploader matches every file against each `-exclude-filters` separately, an alternation of
+    all filters lets it match each file once.
+    """
+    if len(exclude_filters) == 1:
+        return exclude_filters[0]
+    return '(?:' + '|'.join(f'(?:{f})' for f in exclude_filters) + ')'
+
+
+def _read_dumped_file(path: str) -> bytes:
+    """Read a file dumped by casuploader, returns empty bytes if it is not dumped."""
+    try:
+        with open(path, 'rb') as reader:
+            return reader.read()
+    except FileNotFoundError:
+        return b''
+
+
+def _read_client_log(path: str) -> str:
+    return _read_dumped_file(path).decode('utf-8', errors='replace').strip()
+
+
+def _build_command(
+        cas_info: CasInfo,
+        task: UploadTask,
+        working_dir: str,
+        digest_path: str,
+        content_details_path: str,
+) -> list[str]:
+    """Build the casuploader command to upload the file of the task.
+
+    Args:
+      cas_info: the basic CAS server information.
+      task: the artifact file to be uploaded to CAS.
+      working_dir: the directory for intermediate files of the task.
+      digest_path: path where the client dumps the digest of the artifact.
+      content_details_path: path where the client dumps the content details, None to not dump them.
+
+    Returns: the command line of casuploader.
+    """
+    cmd = [
+        cas_info.client_path,
+        '-cas-instance',
+        cas_info.cas_instance,
+        '-cas-addr',
+        cas_info.cas_service,
+        '-dump-digest',
+        digest_path,
+        '-use-adc',
+    ]
+
+    if task.artifact.unzip:
+        cmd.extend(['-zip-path', task.path])
+    else:
+        # TODO(b/250643926) This is a workaround to handle non-directory files.
+        tmp_dir = os.path.join(working_dir, 'dir')
+        os.mkdir(tmp_dir)
+        target_path = os.path.join(tmp_dir, os.path.basename(task.path))
+        # Hard link the file to avoid copying its content. Fall back to copy if the working dir
+        # is on a different file system.
+        try:
+            os.link(task.path, target_path)
+        except OSError:
+            shutil.copy(task.path, target_path)
+        cmd.extend(['-dir-path', tmp_dir])
+
+    if task.artifact.exclude_filters:
+        cmd.extend(['-exclude-filters', _merge_exclude_filters(task.artifact.exclude_filters)])
+
+    if content_details_path:
+        cmd.extend(['-dump-file-details', content_details_path])
+    return cmd
+
+
 def _upload(
         cas_info: CasInfo,
-        artifact: ArtifactConfig,
+        task: UploadTask,
         working_dir: str,
-        log_file: str,
+        timeout: int,
 ) -> str:
     """Upload the artifact to CAS by casuploader binary.
 
     Args:
       cas_info: the basic CAS server information.
-      artifact: the artifact to be uploaded to CAS.
-      working_dir: the directory for intermediate files.
-      log_file: the file where to add the upload logs.
+      task: the artifact file to be uploaded to CAS.
+      working_dir: the directory for intermediate files of the task, removed after uploading.
+      timeout: the timeout in seconds of the CAS client.
 
     Returns: the digest of the uploaded artifact, formatted as "<hash>/<size>".
       returns None if artifact upload fails.
@@ -202,78 +322,64 @@ def _upload(
     if not dump_file_details:
         logging.warning('-dump-file-details is not enabled')
 
-    with tempfile.NamedTemporaryFile(mode='w+') as digest_file, tempfile.NamedTemporaryFile(
-      mode='w+') as content_details_file:
+    os.makedirs(working_dir)
+    digest_path = os.path.join(working_dir, 'digest')
+    content_details_path = os.path.join(working_dir, 'content_details.json')
+    try:
         logging.info(
-            'Uploading %s to CAS instance %s', artifact.source_path, cas_info.cas_instance
+            'Uploading %s to CAS instance %s', task.path, cas_info.cas_instance
         )
+        cmd = _build_command(cas_info, task, working_dir, digest_path,
+                             content_details_path if dump_file_details else None)
 
-        cmd = [
-            cas_info.client_path,
-            '-cas-instance',
-            cas_info.cas_instance,
-            '-cas-addr',
-            cas_info.cas_service,
-            '-dump-digest',
-            digest_file.name,
-            '-use-adc',
-        ]
-
-        if artifact.unzip:
-            cmd = cmd + ['-zip-path', artifact.source_path]
-        else:
-            # TODO(b/250643926) This is a workaround to handle non-directory files.
-            tmp_dir = tempfile.mkdtemp(dir=working_dir)
-            target_path = os.path.join(tmp_dir, os.path.basename(artifact.source_path))
-            shutil.copy(artifact.source_path, target_path)
-            cmd = cmd + ['-dir-path', tmp_dir]
-
-        for exclude_filter in artifact.exclude_filters:
-            cmd = cmd + ['-exclude-filters', exclude_filter]
-
-        if dump_file_details:
-            cmd = cmd + ['-dump-file-details', content_details_file.name]
-
+        # Uploads run in parallel, each of them writes the client output to its own file to keep
+        # the output of an artifact together in the log.
+        client_log_path = os.path.join(working_dir, 'casuploader.log')
         try:
-            logging.info('Running command: %s', cmd)
-            with open(log_file, 'a', encoding='utf8') as outfile:
+            logging.debug('Running command: %s', cmd)
+            with open(client_log_path, 'wb') as client_log:
                 subprocess.run(
                     cmd,
                     check=True,
-                    text=True,
-                    stdout=outfile,
+                    stdout=client_log,
                     stderr=subprocess.STDOUT,
-                    encoding='utf-8',
-                    timeout=UPLOADER_TIMEOUT_SECS
+                    timeout=timeout
                 )
         except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
             logging.warning(
                 'Failed to upload %s to CAS instance %s. Skip.\nError message: %s\nLog: %s',
-                artifact.source_path, cas_info.cas_instance, e, e.stdout,
+                task.path, cas_info.cas_instance, e, _read_client_log(client_log_path),
             )
             return None
         except subprocess.SubprocessError as e:
             logging.warning('Failed to upload %s to CAS instance %s. Skip.\n. Error %s',
-                artifact.source_path, cas_info.cas_instance, e)
+                task.path, cas_info.cas_instance, e)
             return None
+        # Only read the client log back when it is going to be logged.
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(
+                'Client log of uploading %s:\n%s', task.path, _read_client_log(client_log_path))
 
         # Read digest of the root directory or file from dumped digest file.
-        digest = digest_file.read()
+        digest = _read_dumped_file(digest_path).decode('utf-8').strip()
         if digest:
-            logging.info('Uploaded %s to CAS. Digest: %s', artifact.source_path, digest)
+            logging.info('Uploaded %s to CAS. Digest: %s', task.path, digest)
         else:
             logging.warning(
-                'No digest is dumped for file %s, the uploading may fail.', artifact.source_path)
+                'No digest is dumped for file %s, the uploading may fail.', task.path)
             return None
 
         content_details = None
         if dump_file_details:
             try:
-                content_details = json.loads(content_details_file.read())
+                # json.loads decodes the bytes itself, skip decoding them to a str first.
+                content_details = json.loads(_read_dumped_file(content_details_path))
             except json.JSONDecodeError as e:
                 logging.warning('Failed to parse uploaded content details: %s', e)
 
         return UploadResult(digest, content_details)
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
 
 
 def _output_results(
@@ -290,43 +396,136 @@ def _output_results(
     }
     output_path = os.path.join(output_dir, DIGESTS_PATH)
     with open(output_path, 'w', encoding='utf8') as writer:
-        writer.write(json.dumps(digests_output, sort_keys=True, indent=2))
+        json.dump(digests_output, writer, sort_keys=True, indent=2)
     logging.info('Output digests to %s', output_path)
 
     output_path = os.path.join(output_dir, CONTENT_DETAILS_PATH)
-    with open(output_path, 'w', encoding='utf8') as writer:
-        writer.write(json.dumps(content_details, sort_keys=True, indent=2))
+    with open(output_path, 'w', encoding='utf8', buffering=OUTPUT_BUFFER_SIZE) as writer:
+        # Content details can be large, stream it to the file without sorting the keys.
+        json.dump(content_details, writer, indent=2)
     logging.info('Output uploaded content details to %s', output_path)
 
 
+def _walk_files(root: str):
+    """Yield a DirEntry for every file under root, listing each directory only once.
+
+    Hidden files and directories are skipped and symlinks to directories are followed, the same as
+    glob does.
+    """
+    dirs = [root]
+    # Identities of the listed directories, so that a symlink loop is not followed forever.
+    visited = set()
+    while dirs:
+        path = dirs.pop()
+        try:
+            stat = os.stat(path)
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        dirs.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+        except OSError as e:
+            logging.warning('Failed to scan directory: %s', e)
+
+
+def _find_artifact_files(dist_dir: str, artifacts: list[ArtifactConfig]) -> list[list[str]]:
+    """Find files matching the artifacts with a single walk of the dist directory.
+
+    A file matching the patterns of more than one artifact is assigned to each of them.
+
+    Returns: a list of matched file paths for each artifact, in the order of the artifacts.
+    """
+    matched_files = [[] for _ in artifacts]
+    if not artifacts:
+        return matched_files
+    translated = [fnmatch.translate(artifact.source_path) for artifact in artifacts]
+    patterns = [re.compile(t) for t in translated]
+    # Most files match none of the artifacts, reject them with a single match of an alternation
+    # of all patterns before trying the patterns one by one.
+    any_pattern = re.compile('|'.join(f'(?:{t})' for t in translated))
+    for entry in _walk_files(dist_dir):
+        if not any_pattern.match(entry.name):
+            continue
+        for files, pattern in zip(matched_files, patterns):
+            if pattern.match(entry.name):
+                files.append(entry.path)
+    return matched_files
+
+
+def _upload_with_elapsed_time(
+        cas_info: CasInfo,
+        task: UploadTask,
+        working_dir: str,
+        timeout: int,
+) -> UploadResult:
+    start = time.monotonic()
+    result = _upload(cas_info, task, working_dir, timeout)
+    logging.info(
+        'Elapsed time of uploading %s: %d seconds\n\n',
+        task.path,
+        time.monotonic() - start,
+    )
+    return result
+
+
+def _run_upload_tasks(cas_info: CasInfo, tasks: list[UploadTask], working_dir: str,
+    max_workers: int) -> list[UploadResult]:
+    """Upload the files of the tasks in parallel.
+
+    Returns: the upload result of each task, in the order of the tasks.
+    """
+    timeout = min(UPLOADER_TIMEOUT_SECS * min(max_workers, len(tasks)), UPLOADER_MAX_TIMEOUT_SECS)
+    # Uploading is bound by the casuploader subprocesses, threads are enough to run them in
+    # parallel.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Submit the largest files first, so that a large artifact does not start last and hold
+        # up the end of the run.
+        submit_order = sorted(
+            range(len(tasks)), key=lambda i: os.path.getsize(tasks[i].path), reverse=True)
+        futures = {
+            i: executor.submit(
+                _upload_with_elapsed_time,
+                cas_info,
+                tasks[i],
+                os.path.join(working_dir, str(i)),
+                timeout,
+            )
+            for i in submit_order
+        }
+        return [futures[i].result() for i in range(len(tasks))]
+
+
 def _upload_all_artifacts(cas_info: CasInfo, all_artifacts: ArtifactConfig,
-    dist_dir: str, working_dir: str, log_file:str):
+    dist_dir: str, working_dir: str, max_workers: int):
+    tasks = [
+        UploadTask(artifact, f)
+        for artifact, files in zip(all_artifacts, _find_artifact_files(dist_dir, all_artifacts))
+        for f in files
+    ]
+
     file_digests = {}
     content_details = []
-    for artifact in all_artifacts:
-        source_path = artifact.source_path
-        for f in glob.glob(dist_dir + '/**/' + source_path, recursive=True):
-            start = time.time()
-            name = os.path.basename(f)
-            artifact.source_path = f
-            result = _upload(cas_info, artifact, working_dir, log_file)
-
-            if result and result.digest:
-                file_digests[name] = result.digest
-            else:
-                logging.warning(
-                    'Skip to save the digest of file %s, the uploading may fail', name
-                )
-            if result and result.content_details:
-                content_details.append({"artifact": name, "details": result.content_details})
-            else:
-                logging.warning('Skip to save the content details of file %s', name)
+    results = _run_upload_tasks(cas_info, tasks, working_dir, max_workers)
+    for task, result in zip(tasks, results):
+        name = os.path.basename(task.path)
 
-            logging.info(
-                'Elapsed time of uploading %s: %d seconds\n\n',
-                artifact.source_path,
-                time.time() - start,
+        if result and result.digest:
+            file_digests[name] = result.digest
+        else:
+            logging.warning(
+                'Skip to save the digest of file %s, the uploading may fail', name
             )
+        if result and result.content_details:
+            content_details.append({"artifact": name, "details": result.content_details})
+        else:
+            logging.warning('Skip to save the content details of file %s', name)
+
     _output_results(
         cas_info,
         dist_dir,
@@ -346,6 +545,18 @@ def main():
         default=[],
         help='Name of configuration which artifact to upload',
     )
+    parser.add_argument(
+        '--max_workers',
+        required=False,
+        type=_positive_int,
+        default=MAX_WORKERS,
+        help='Number of artifacts to upload in parallel',
+    )
+    parser.add_argument(
+        '--log_env',
+        action='store_true',
+        help=f'Output environment variables of the running server to {ENV_PATH}',
+    )
     args = parser.parse_args()
 
     dist_dir = _get_env_var('DIST_DIR', check=True)
@@ -356,18 +567,28 @@ def main():
         format='%(asctime)s %(levelname)s %(message)s',
         filename=log_file,
     )
-    logging.info('Environment variables of running server: %s', os.environ)
+    if args.log_env:
+        env_file = os.path.join(dist_dir, ENV_PATH)
+        with open(env_file, 'w', encoding='utf8') as writer:
+            json.dump(dict(os.environ), writer, sort_keys=True, indent=2)
+        logging.info('Output environment variables of running server to %s', env_file)
 
     additional_artifacts = _parse_additional_artifacts(args)
     cas_info = _init_cas_info()
 
-    with tempfile.TemporaryDirectory() as working_dir:
+    # Create the working dir next to the dist dir rather than inside it, so that it is never
+    # published with the dist dir but usually on the same file system to hard link files into it.
+    working_root = os.path.dirname(os.path.abspath(dist_dir))
+    if not os.access(working_root, os.W_OK):
+        working_root = None
+    with tempfile.TemporaryDirectory(dir=working_root, prefix='cas_uploader_') as working_dir:
         logging.info('The working dir is %s', working_dir)
-        start = time.time()
+        logging.info('Uploading with %d workers', args.max_workers)
+        start = time.monotonic()
         _upload_all_artifacts(cas_info, ARTIFACTS + additional_artifacts,
-            dist_dir, working_dir, log_file)
+            dist_dir, working_dir, args.max_workers)
         logging.info('Total time of uploading build artifacts to CAS: %d seconds',
-                     time.time() - start)
+                     time.monotonic() - start)
 
 
 if __name__ == '__main__':